@@ -25,6 +25,34 @@ def isolated_environment(
     return env
 
 
+def _isolated_environment_worker(
+    spec: tuple[Union[Path, str], list[str] | None],
+) -> dict[str, Any]:
+    """Worker entry point for isolated_environments_bulk."""
+    env_path, requirements = spec
+    return isolated_environment(env_path, requirements)
+
+
+def isolated_environments_bulk(
+    specs: list[tuple[Union[Path, str], list[str] | None]],
+    max_workers: int | None = None,
+) -> list[dict[str, Any]]:
+    """
+    Creates several isolated environments in parallel processes.
+    Each spec is (env_path, requirements) and the returned environments
+    are in the same order as the specs.
+    """
+    if not specs:
+        return []
+    # Imported here, multiprocessing is slow to import and rarely needed.
+    from concurrent.futures import (  # pylint: disable=import-outside-toplevel
+        ProcessPoolExecutor,
+    )
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(_isolated_environment_worker, specs))
+
+
 def isolated_environment_run(
     env_path: Union[Path, str],
     requirements: list[str] | None,
@@ -45,10 +73,10 @@ def isolated_environment_run(
     requirements = requirements or []
     # reqs = Requirements(requirements)
     reqs = None if not requirements else "\n".join(requirements) + "\n"
+    # The constructor already ensures the requirements are installed.
     iso_env = IsolatedEnvironment(
         env_path=env_path, requirements=reqs, full_isolation=full_isolation
     )
-    iso_env.ensure_installed(reqs)
     cp = iso_env.run(cmd_list, **kwargs)
     return cp
 
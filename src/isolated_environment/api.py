@@ -5,25 +5,255 @@ then populate it with packages incrementally. Also allows the
 ability to run commands in the environment.
 """
 
-import json
+import errno
+import functools
+import hashlib
+import logging
 import os
+import re
+import shlex
 import shutil
+import stat
 import subprocess
 import sys
+import threading
 import venv
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from dataclasses import dataclass
 from pathlib import Path
-from shutil import which
+from tempfile import TemporaryDirectory
 from typing import Any, Iterator
 
-from filelock import FileLock
+if sys.platform == "win32":
+    import msvcrt  # pylint: disable=import-error
+else:
+    import fcntl
+
+# Platform checks that guard the msvcrt/fcntl calls stay spelled out so
+# type checkers can narrow on them.
+_IS_WIN = sys.platform == "win32"
+_SCRIPTS = "Scripts" if _IS_WIN else "bin"
+_PYTHON = "python.exe" if _IS_WIN else "python"
+if _IS_WIN:
+    _SITE_PACKAGES_REL = Path("Lib") / "site-packages"
+else:
+    _PY_VERSION = f"python{sys.version_info[0]}.{sys.version_info[1]}"
+    _SITE_PACKAGES_REL = Path("lib") / _PY_VERSION / "site-packages"
+_PATH_SEP = os.pathsep
+
+_NAME_END = re.compile(r"[\s\[<>=!~;@]")
+_NAME_SEPARATORS = re.compile(r"[-_.]+")
+
+logger = logging.getLogger("isolated_environment")
+
+# Upper bound on concurrent pip processes for a pinned install, each one
+# resolves the index and holds its own downloads in memory.
+_MAX_SHARDS = 4
+
+# Requirement file options that apply to every package, so each shard of a
+# parallel install can repeat them.
+_SHARD_OPTIONS = frozenset(
+    (
+        "-i",
+        "--index-url",
+        "--extra-index-url",
+        "-f",
+        "--find-links",
+        "--no-index",
+        "--trusted-host",
+        "--pre",
+        "--prefer-binary",
+        "--only-binary",
+        "--no-binary",
+    )
+)
+
+_TEMPLATE_MARKER = ".isolated_environment_template"
+_FROM_TEMPLATE_MARKER = ".isolated_environment_from_template"
 
 WARNED_ONCE = int(os.environ.get("SILENCE_FULL_ISOLATION_WARNING", "0")) == 1
 
 
-@dataclass
+class _ProcessLock:
+    """State shared by every FileLock on the same path within this process.
+
+    POSIX record locks belong to the process rather than the file descriptor,
+    and closing any descriptor of the file drops them, so threads coordinate
+    here and the descriptor is only open while the process holds the lock.
+    The holders are tracked per thread so a holder can acquire it again.
+    """
+
+    def __init__(self, lock_file: str) -> None:
+        self.lock_file = lock_file
+        self.cond = threading.Condition()
+        # Thread id -> number of shared holds.
+        self.readers: dict[int, int] = {}
+        # Thread id of the exclusive holder and its number of holds.
+        self.writer: int | None = None
+        self.depth = 0
+        # Shared holds the writer let go of to upgrade, restored on release.
+        self.upgraded = 0
+        self.fd: int | None = None
+
+    def reset_in_child(self) -> None:
+        """Forgets the holders after fork(), record locks are not inherited
+        and the holding threads do not exist in the child."""
+        self.cond = threading.Condition()
+        self.readers = {}
+        self.writer = None
+        self.depth = 0
+        self.upgraded = 0
+        if self.fd is not None:
+            # Closing the child's copy leaves the parent's record lock alone.
+            os.close(self.fd)
+            self.fd = None
+
+    def os_lock(self, exclusive: bool) -> None:
+        self.fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            self.os_relock(exclusive)
+        except BaseException:
+            os.close(self.fd)
+            self.fd = None
+            raise
+
+    def os_relock(self, exclusive: bool) -> None:
+        """Takes the record lock, or converts the one already held."""
+        assert self.fd is not None
+        if sys.platform == "win32":
+            while True:
+                try:
+                    msvcrt.locking(self.fd, msvcrt.LK_LOCK, 1)
+                    break
+                except OSError as exc:
+                    # LK_LOCK gives up after ~10 seconds, keep waiting.
+                    if exc.errno != errno.EDEADLOCK:
+                        raise
+        else:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+    def os_unlock(self) -> None:
+        assert self.fd is not None
+        try:
+            if sys.platform == "win32":
+                os.lseek(self.fd, 0, os.SEEK_SET)
+                msvcrt.locking(self.fd, msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+
+_PROCESS_LOCKS: dict[str, _ProcessLock] = {}
+_PROCESS_LOCKS_GUARD = threading.Lock()
+
+
+def _reset_process_locks_in_child() -> None:
+    global _PROCESS_LOCKS_GUARD  # pylint: disable=global-statement
+    _PROCESS_LOCKS_GUARD = threading.Lock()
+    # Reset in place, FileLock objects keep a reference to their state.
+    for state in _PROCESS_LOCKS.values():
+        state.reset_in_child()
+
+
+if hasattr(os, "register_at_fork"):  # Not on windows.
+    os.register_at_fork(after_in_child=_reset_process_locks_in_child)
+
+
+def _process_lock(lock_file: str) -> _ProcessLock:
+    key = os.path.abspath(lock_file)
+    with _PROCESS_LOCKS_GUARD:
+        state = _PROCESS_LOCKS.get(key)
+        if state is None:
+            state = _PROCESS_LOCKS[key] = _ProcessLock(key)
+        return state
+
+
+class FileLock:
+    """An inter-process lock on a file, using a POSIX record lock
+    (fcntl.lockf, which is also honoured across hosts on NFS) or
+    msvcrt.locking on windows. Shared holders may overlap with each other
+    but never with an exclusive holder; windows has no shared mode so it is
+    always exclusive there."""
+
+    def __init__(self, lock_file: str) -> None:
+        self.lock_file = lock_file
+        self._state = _process_lock(lock_file)
+
+    def acquire(self, exclusive: bool = True) -> None:
+        """Blocks until the lock is held. A thread that already holds the lock
+        may acquire it again, each acquire needs a matching release. Upgrading
+        a shared hold to an exclusive one lets go of it while waiting, so
+        another holder may get the lock in between."""
+        state = self._state
+        me = threading.get_ident()
+        if sys.platform == "win32":
+            exclusive = True
+        with state.cond:
+            if state.writer == me:
+                state.depth += 1
+                return
+            if not exclusive:
+                state.cond.wait_for(lambda: state.writer is None)
+                if state.readers:
+                    # The process already holds the shared record lock.
+                    state.readers[me] = state.readers.get(me, 0) + 1
+                    return
+                state.os_lock(exclusive=False)
+                state.readers[me] = 1
+                return
+            # Waiting on other readers while holding a shared hold deadlocks
+            # when two of them upgrade, so let go of it until released.
+            upgraded = state.readers.pop(me, 0)
+            state.cond.wait_for(lambda: state.writer is None and not state.readers)
+            # Nobody else in the process holds the lock, so blocking on the
+            # record lock while holding cond can not starve a release.
+            if state.fd is not None:
+                # Still open from this thread's own shared hold.
+                state.os_relock(exclusive=True)
+            else:
+                state.os_lock(exclusive=True)
+            state.writer = me
+            state.depth = 1
+            state.upgraded = upgraded
+
+    def release(self) -> None:
+        """Releases the lock."""
+        state = self._state
+        me = threading.get_ident()
+        with state.cond:
+            if state.writer == me:
+                state.depth -= 1
+                if state.depth:
+                    return
+                state.writer = None
+                if state.upgraded:
+                    # Back to the shared hold this thread upgraded from.
+                    state.readers[me] = state.upgraded
+                    state.upgraded = 0
+                    state.os_relock(exclusive=False)
+                else:
+                    state.os_unlock()
+            else:
+                state.readers[me] -= 1
+                if not state.readers[me]:
+                    del state.readers[me]
+                if not state.readers:
+                    state.os_unlock()
+            state.cond.notify_all()
+
+    def __enter__(self) -> "FileLock":
+        self.acquire()
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.release()
+
+
+@dataclass(slots=True)
 class ActivatedEnvironment:
     """An activated environment."""
 
@@ -32,45 +262,332 @@ class ActivatedEnvironment:
     pip: Path
 
 
+def _cache_dir() -> Path:
+    """Gets the cache directory, honouring XDG_CACHE_HOME."""
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "isolated_environment"
+
+
+def _template_path() -> Path:
+    """Gets the template environment path for the running interpreter."""
+    major, minor = sys.version_info[:2]
+    exe_hash = hashlib.sha1(sys.executable.encode("utf-8")).hexdigest()[:8]
+    return _cache_dir() / f"template-py{major}.{minor}-{exe_hash}"
+
+
+def _reflink_or_copy(src: str, dst: str) -> str:
+    """Copies a file, letting the kernel share extents (reflink/CoW) when the
+    filesystem supports it."""
+    copy_file_range = getattr(os, "copy_file_range", None)
+    if copy_file_range is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                while copy_file_range(fsrc.fileno(), fdst.fileno(), 1 << 30) > 0:
+                    pass
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+def _hardlink_or_copy(src: str, dst: str) -> str:
+    """Hard links a file, copying when the link crosses filesystems."""
+    try:
+        os.link(src, dst)
+        return dst
+    except OSError:
+        return _reflink_or_copy(src, dst)
+
+
+def _ensure_template() -> Path:
+    """Creates the template environment once, shared by all processes."""
+    template = _template_path()
+    if (template / _TEMPLATE_MARKER).exists():
+        return template
+    template.parent.mkdir(parents=True, exist_ok=True)
+    with FileLock(str(template) + ".lock"):
+        if not (template / _TEMPLATE_MARKER).exists():
+            shutil.rmtree(template, ignore_errors=True)
+            venv.create(template, with_pip=True)
+            (template / _TEMPLATE_MARKER).write_text(str(template))
+    return template
+
+
+def _relocate(env_path: Path, template: Path) -> None:
+    """Rewrites the template paths baked into scripts and pyvenv.cfg."""
+    replacements = [
+        (str(template).encode("utf-8"), str(env_path).encode("utf-8")),
+        (f"({template.name}) ".encode("utf-8"), f"({env_path.name}) ".encode("utf-8")),
+    ]
+    files = [env_path / "pyvenv.cfg"] + list((env_path / _SCRIPTS).iterdir())
+    for file in files:
+        if file.is_symlink() or not file.is_file():
+            continue
+        data = file.read_bytes()
+        new_data = data
+        for old, new in replacements:
+            new_data = new_data.replace(old, new)
+        if new_data != data:
+            # Unlink first so a hard linked template file is left untouched.
+            mode = file.stat().st_mode
+            file.unlink()
+            file.write_bytes(new_data)
+            os.chmod(file, stat.S_IMODE(mode))
+
+
+def _reset_to_template(env_path: Path) -> bool:
+    """Removes everything installed on top of the template the environment was
+    copied from. Returns False if the environment can not be reset this way."""
+    try:
+        template = Path((env_path / _FROM_TEMPLATE_MARKER).read_text())
+    except FileNotFoundError:
+        return False
+    template_site = _site_packages(template)
+    site = _site_packages(env_path)
+    if not template_site.exists() or not site.exists():
+        return False
+    # If a template package was upgraded or removed its dist-info is gone and
+    # only a full rebuild restores it.
+    template_dists = {n for n in os.listdir(template_site) if n.endswith(".dist-info")}
+    if not template_dists.issubset(os.listdir(site)):
+        return False
+    for directory, reference in (
+        (env_path, template),
+        (env_path / _SCRIPTS, template / _SCRIPTS),
+        (site, template_site),
+    ):
+        keep = set(os.listdir(reference)) | {_FROM_TEMPLATE_MARKER}
+        for name in os.listdir(directory):
+            if name in keep:
+                continue
+            path = directory / name
+            if path.is_dir() and not path.is_symlink():
+                shutil.rmtree(path)
+            else:
+                path.unlink()
+    return True
+
+
 def _create_virtual_env(env_path: Path) -> Path:
     """Creates an empty virtual environment in the current directory using venv."""
 
     # Create parent directories
     env_path.parent.mkdir(parents=True, exist_ok=True)
     # Create the virtual environment
-    venv.create(env_path, with_pip=True)
+    if _IS_WIN or os.environ.get("ISOLATED_ENVIRONMENT_NO_TEMPLATE"):
+        # The windows pip.exe launchers embed the interpreter path, so they
+        # can not be relocated by rewriting text.
+        venv.create(env_path, with_pip=True)
+    else:
+        # Copying a prebuilt template skips the slow ensurepip bootstrap.
+        template = _ensure_template()
+        if os.environ.get("ISOLATED_ENVIRONMENT_LINK_MODE") == "hardlink":
+            copy_function = _hardlink_or_copy
+        else:
+            copy_function = _reflink_or_copy
+        shutil.copytree(
+            template,
+            env_path,
+            symlinks=True,
+            copy_function=copy_function,
+            ignore=shutil.ignore_patterns(_TEMPLATE_MARKER),
+            dirs_exist_ok=True,
+        )
+        _relocate(env_path, template)
+        (env_path / _FROM_TEMPLATE_MARKER).write_text(str(template))
     env_name = env_path.name
-    print(f"Virtual environment '{env_name}' created at {env_path}")
+    logger.info("Virtual environment '%s' created at %s", env_name, env_path)
     return env_path
 
 
 def has_python_or_pip(path: str) -> bool:
     """Returns True if python or pip is in the path."""
-    python = which("python", path=path) or which("python3", path=path)
-    pip = which("pip", path=path) or which("pip3", path=path)
+    python = shutil.which("python", path=path) or shutil.which("python3", path=path)
+    pip = shutil.which("pip", path=path) or shutil.which("pip3", path=path)
     return (python is not None) or (pip is not None)
 
 
-def _get_activated_environment(
-    env_path: Path, full_isolation: bool
-) -> ActivatedEnvironment:
-    """Gets the activate environment for the environment."""
+def _environment_overlay(env_path: Path) -> ActivatedEnvironment:
+    """Gets the per-environment part of the activated environment, its env
+    only holds what is set on top of os.environ, PATH being the prefix."""
+    bin_dir = env_path / _SCRIPTS
+    return ActivatedEnvironment(
+        # set VIRTUAL_ENV to make sure Python finds the correct packages
+        env={"VIRTUAL_ENV": str(env_path), "PATH": str(bin_dir)},
+        python=bin_dir / _PYTHON,
+        pip=bin_dir / "pip",
+    )
+
+
+def _apply_overlay(overlay: ActivatedEnvironment) -> ActivatedEnvironment:
+    """Merges the overlay with the current os.environ."""
+    bin_dir = overlay.env["PATH"]
+    base_path = os.environ.get("PATH")
+    out_env = {
+        **os.environ,
+        **overlay.env,
+        "PATH": f"{bin_dir}{_PATH_SEP}{base_path}" if base_path else bin_dir,
+    }
+    # Like the activate scripts, drop PYTHONHOME so it can't point the
+    # interpreter at another installation.
+    out_env.pop("PYTHONHOME", None)
+    # Every environment already shares pip's per-user cache, only point pip
+    # somewhere else when asked to.
+    pip_cache = os.environ.get("ISOLATED_ENVIRONMENT_PIP_CACHE")
+    if pip_cache:
+        out_env["PIP_CACHE_DIR"] = pip_cache
+    return ActivatedEnvironment(env=out_env, python=overlay.python, pip=overlay.pip)
+
+
+def _warn_full_isolation(full_isolation: bool) -> None:
+    """Warns once that full_isolation is ignored."""
     global WARNED_ONCE  # pylint: disable=global-statement
     if full_isolation:
         if not WARNED_ONCE:
             warnings.warn("Warning: full_isolation is deprecated and now ignored.")
             WARNED_ONCE = True
-    out_env = os.environ.copy()
-    # set VIRTUAL_ENV to make sure Python finds the correct packages
-    out_env["VIRTUAL_ENV"] = str(env_path)
-    scripts = "Scripts" if sys.platform == "win32" else "bin"
-    python_name = "python.exe" if sys.platform == "win32" else "python"
-    python = env_path / scripts / python_name
-    pip = env_path / scripts / "pip"
-    activate_environment: ActivatedEnvironment = ActivatedEnvironment(
-        env=out_env, python=python, pip=pip
-    )
-    return activate_environment
+
+
+def _get_activated_environment(
+    env_path: Path, full_isolation: bool
+) -> ActivatedEnvironment:
+    """Gets the activate environment for the environment."""
+    _warn_full_isolation(full_isolation)
+    return _apply_overlay(_environment_overlay(env_path))
+
+
+@functools.lru_cache(maxsize=4096)
+def _package_name(requirement: str) -> str:
+    """Gets the normalized (PEP 503) package name of a requirement."""
+    requirement = requirement.strip()
+    match = _NAME_END.search(requirement)
+    name = requirement[: match.start()] if match else requirement
+    return _NAME_SEPARATORS.sub("-", name).lower()
+
+
+def _requirement_lines(requirements: str | None) -> set[str]:
+    """Gets the set of non-empty, non-comment requirement lines."""
+    if not requirements:
+        return set()
+    out: set[str] = set()
+    for line in requirements.splitlines():
+        line = " ".join(line.split())
+        if line and not line.startswith("#"):
+            out.add(line)
+    return out
+
+
+def _only_adds_requirements(prev_reqs: str | None, reqs: str | None) -> bool:
+    """Returns True if reqs keeps every line of prev_reqs and adds packages."""
+    prev_lines = _requirement_lines(prev_reqs)
+    new_lines = _requirement_lines(reqs)
+    if not prev_lines.issubset(new_lines):
+        return False
+    return any(not line.startswith("-") for line in new_lines - prev_lines)
+
+
+def _write_text_atomic(path: Path, text: str) -> None:
+    """Writes the file so readers see either the old or the new contents,
+    never a truncated file."""
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(text)
+    os.replace(tmp, path)
+
+
+def _site_packages(env_path: Path) -> Path:
+    """Gets the site-packages directory of the environment."""
+    return env_path / _SITE_PACKAGES_REL
+
+
+def _log_command(cmd_list: list[str]) -> None:
+    """Logs the command, only paying for the quoting when debug is enabled."""
+    if logger.isEnabledFor(logging.DEBUG):
+        cmd = subprocess.list2cmdline(cmd_list) if _IS_WIN else shlex.join(cmd_list)
+        logger.debug("Running: %s", cmd)
+
+
+def _pip_install_cmd(act_env: ActivatedEnvironment) -> list[str]:
+    """Gets the install command, using uv when it is enabled and available."""
+    if os.environ.get("ISOLATED_ENVIRONMENT_USE_UV") == "1":
+        uv = shutil.which("uv")
+        if uv is not None:
+            return [uv, "pip", "install", "--python", str(act_env.python)]
+    # Running pip as a module skips the console script shim, which on
+    # windows is a launcher exe that spawns a second process.
+    return [str(act_env.python), "-m", "pip", "install"]
+
+
+def _logical_lines(requirements: str) -> list[str]:
+    """Splits a requirements file into lines, keeping backslash continuations
+    (as written by pip-compile) together with the line they continue."""
+    out: list[str] = []
+    current = ""
+    for line in requirements.splitlines():
+        current += line + "\n"
+        if not line.rstrip().endswith("\\"):
+            out.append(current)
+            current = ""
+    if current:
+        out.append(current)
+    return out
+
+
+def _pinned_shards(requirements: str) -> tuple[list[str], list[str]] | None:
+    """If every requirement is pinned, returns the global option lines and the
+    package lines, verbatim, otherwise None."""
+    options: list[str] = []
+    packages: list[str] = []
+    for line in _logical_lines(requirements):
+        stripped = line.strip()
+        if not stripped or stripped.startswith("#"):
+            continue
+        if stripped.startswith("-"):
+            # -e/-r/-c and friends are not global, they can't go in every shard.
+            if stripped.split()[0].split("=")[0] not in _SHARD_OPTIONS:
+                return None
+            options.append(line)
+            continue
+        # The specifier ends at the environment marker or the per-line options.
+        spec = re.split(r";|\s--", stripped, maxsplit=1)[0]
+        if "==" not in spec and "@" not in spec:
+            return None
+        packages.append(line)
+    if not packages:
+        return None
+    return options, packages
+
+
+def _pip_install_pinned(
+    act_env: ActivatedEnvironment,
+    env_path: Path,
+    options: list[str],
+    packages: list[str],
+    args: list[str],
+) -> None:
+    """Installs the pinned packages concurrently, sharded across pip processes.
+    Each shard gets its own requirements file so markers, hashes and line
+    continuations reach pip untouched."""
+    num_shards = min(len(packages), os.cpu_count() or 1, _MAX_SHARDS)
+    shards: list[list[str]] = [[] for _ in range(num_shards)]
+    for i, line in enumerate(packages):
+        shards[i % num_shards].append(line)
+    shard_files = [env_path / f"requirements.shard{i}.txt" for i in range(num_shards)]
+    for shard_file, shard in zip(shard_files, shards):
+        shard_file.write_text("".join(options + shard))
+
+    def install(shard_file: Path) -> None:
+        cmd_list = [*_pip_install_cmd(act_env), *args, "-r", str(shard_file)]
+        _log_command(cmd_list)
+        subprocess.run(cmd_list, env=act_env.env, shell=False, check=True)
+
+    try:
+        with ThreadPoolExecutor(max_workers=num_shards) as executor:
+            # list() forces any CalledProcessError to propagate.
+            list(executor.map(install, shard_files))
+    finally:
+        for shard_file in shard_files:
+            shard_file.unlink(missing_ok=True)
 
 
 def _pip_install_all(
@@ -78,20 +595,32 @@ def _pip_install_all(
 ) -> None:
     """Installs all the packages"""
     act_env = _get_activated_environment(env_path, full_isolation)
-    # write out requirements file
-    req_file = env_path / "requirements.txt"
+    # pip gets its own copy, requirements.txt records what was installed and
+    # is only written once the install succeeded.
+    req_file = env_path / "requirements.install.txt"
     req_file.write_text(requiresments)
-    cmd_list = [str(act_env.pip), "install"]
-    if args:
-        cmd_list += args
-    cmd_list += ["-r"]
-    cmd_list += [str(req_file)]
-    cmd = subprocess.list2cmdline(cmd_list)
-    print(f"Running: {cmd}")
-    subprocess.run(cmd, env=act_env.env, shell=True, check=True)
+    try:
+        # With --no-deps the caller vouches that the requirements are a
+        # complete lock, so fully pinned packages need no resolution and can
+        # be installed in parallel.
+        if args and "--no-deps" in args:
+            pinned = _pinned_shards(requiresments)
+            if pinned is not None:
+                options, packages = pinned
+                _pip_install_pinned(act_env, env_path, options, packages, args)
+                return
+        cmd_list = _pip_install_cmd(act_env)
+        if args:
+            cmd_list += args
+        cmd_list += ["-r"]
+        cmd_list += [str(req_file)]
+        _log_command(cmd_list)
+        subprocess.run(cmd_list, env=act_env.env, shell=False, check=True)
+    finally:
+        req_file.unlink(missing_ok=True)
 
 
-class IsolatedEnvironment:
+class IsolatedEnvironment:  # pylint: disable=too-many-instance-attributes
     """An isolated environment."""
 
     def __init__(
@@ -106,6 +635,13 @@ class IsolatedEnvironment:
         # file_lock is side-by-side with the environment.
         self.file_lock = FileLock(str(env_path) + ".lock")
         self.requirements = env_path / "requirements.txt"
+        self._bin_dir = env_path / _SCRIPTS
+        self._installed_known = False
+        self._overlay_cache: ActivatedEnvironment | None = None
+        # (site-packages mtime, parsed pip list, normalized package names)
+        self._pip_list_cache: tuple[int, Any, frozenset[str]] | None = None
+        # ((requirements mtime, size), requirements)
+        self._reqs_cache: tuple[tuple[int, int], str | None] | None = None
         self.ensure_installed(requirements)
 
     def install_environment(self) -> None:
@@ -113,20 +649,34 @@ class IsolatedEnvironment:
         assert (
             not self.installed()
         ), f"The environment {self.env_path} is already installed."
+        self._install_environment()
+
+    def _install_environment(self) -> None:
+        """Installs the environment, the caller has checked it isn't installed."""
         self.env_path = _create_virtual_env(self.env_path)
+        self._overlay_cache = None
+        self._installed_known = True
 
     def installed(self) -> bool:
         """Returns True if the environment is installed."""
-        if not self.env_path.exists():
-            return False
-        if sys.platform == "win32":
-            return self.env_path.exists() and (self.env_path / "Scripts").exists()
-        return self.env_path.exists() and (self.env_path / "bin").exists()
+        if self._installed_known:
+            return True
+        # The bin directory existing implies the environment directory does.
+        try:
+            installed = stat.S_ISDIR(os.stat(self._bin_dir).st_mode)
+        except (FileNotFoundError, NotADirectoryError):
+            installed = False
+        # Only a positive answer is remembered, until clean() removes it.
+        self._installed_known = installed
+        return installed
 
     def clean(self) -> None:
         """Cleans the environment."""
         if self.env_path.exists():
             shutil.rmtree(self.env_path, ignore_errors=True)
+        self._overlay_cache = None
+        self._installed_known = False
+        self._pip_list_cache = None
 
     def _read_reqs(self) -> str | None:
         """Reads the packages.json file."""
@@ -135,41 +685,62 @@ class IsolatedEnvironment:
             return None
         return data
 
+    def _read_prev_reqs(self) -> str | None:
+        """Reads the installed requirements, or None if there are none."""
+        try:
+            st = self.requirements.stat()
+        except FileNotFoundError:
+            return None
+        # Only re-read the file when it has been rewritten since the last read.
+        key = (st.st_mtime_ns, st.st_size)
+        if self._reqs_cache is not None and self._reqs_cache[0] == key:
+            return self._reqs_cache[1]
+        try:
+            prev_reqs: str | None = self.requirements.read_text()
+        except FileNotFoundError:
+            return None
+        if prev_reqs == "None":
+            prev_reqs = None
+        self._reqs_cache = (key, prev_reqs)
+        return prev_reqs
+
     @contextmanager
-    def lock(self) -> Iterator[None]:
-        """Locks the environment to prevent it from being used."""
-        self.file_lock.acquire()
+    def lock(self, exclusive: bool = True) -> Iterator[None]:
+        """Locks the environment to prevent it from being used. A shared
+        (non exclusive) lock only keeps out exclusive holders, which is
+        enough for callers that just read the environment."""
+        self.file_lock.acquire(exclusive=exclusive)
         try:
             yield
         finally:
             self.file_lock.release()
 
+    def _activated_environment(self) -> ActivatedEnvironment:
+        """Gets the activated environment for the current os.environ, only the
+        per-environment overlay is cached."""
+        if self._overlay_cache is None:
+            _warn_full_isolation(self.full_isolation)
+            self._overlay_cache = _environment_overlay(self.env_path)
+        return _apply_overlay(self._overlay_cache)
+
     def environment(self) -> dict[str, str]:
         """Gets the activated environment, which should be applied to subprocess environments."""
-        return _get_activated_environment(self.env_path, self.full_isolation).env
+        # A fresh dict each call, so callers are free to mutate it.
+        return self._activated_environment().env
 
     def run(self, cmd_list: list[str], **kwargs) -> subprocess.CompletedProcess:
         """Runs a command in the environment."""
-        act_env = _get_activated_environment(self.env_path, self.full_isolation)
-        env = act_env.env
-        capture_output = kwargs.get("capture_output", False)
-        if "capture_output" in kwargs:
-            del kwargs["capture_output"]
-        check = kwargs.get("check", False)
-        if "check" in kwargs:
-            del kwargs["check"]
-
-        universal_newlines = kwargs.get("universal_newlines", True)
-        if "universal_newlines" in kwargs:
-            del kwargs["universal_newlines"]
-        text = kwargs.get("text", universal_newlines)
-        if "text" in kwargs:
-            del kwargs["text"]
-        shell = kwargs.get("shell", False)
-        cmd_or_cmd_list = subprocess.list2cmdline(cmd_list) if shell else cmd_list
+        capture_output = kwargs.pop("capture_output", False)
+        check = kwargs.pop("check", False)
+        universal_newlines = kwargs.pop("universal_newlines", True)
+        text = kwargs.pop("text", universal_newlines)
+        if kwargs.get("shell", False):
+            cmd_or_cmd_list: str | list[str] = subprocess.list2cmdline(cmd_list)
+        else:
+            cmd_or_cmd_list = cmd_list
         cp = subprocess.run(
             cmd_or_cmd_list,
-            env=env,
+            env=self._activated_environment().env,
             check=check,
             text=text,
             capture_output=capture_output,
@@ -178,58 +749,170 @@ class IsolatedEnvironment:
         )
         return cp
 
+    def batch_run(
+        self, cmd_lists: list[list[str]], max_workers: int = 8, **kwargs
+    ) -> list[subprocess.CompletedProcess]:
+        """Runs several commands in the environment concurrently, results are
+        returned in the same order as the commands."""
+        if not cmd_lists:
+            return []
+        max_workers = max(1, min(max_workers, len(cmd_lists)))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.run, cmd, **kwargs) for cmd in cmd_lists]
+            return [future.result() for future in futures]
+
     def pip_list(self) -> dict[str, Any]:
         """Returns a dictionary of installed packages."""
         if not self.installed():
             return {}
-        env = self.environment()
-        cmd_list = ["pip", "list", "--format", "json"]
-        cmd = subprocess.list2cmdline(cmd_list)
-        completed = subprocess.run(
-            cmd,
-            env=env,
-            shell=True,
-            check=True,
-            capture_output=True,
-            universal_newlines=True,
-        )
-        stdout = completed.stdout
-        out = json.loads(stdout)
-        return out  # type: ignore
+        # Installing or removing a package adds or removes a dist-info
+        # directory, which bumps the mtime of site-packages.
+        try:
+            mtime = _site_packages(self.env_path).stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = -1
+        if self._pip_list_cache is not None and self._pip_list_cache[0] == mtime:
+            return list(self._pip_list_cache[1])  # type: ignore
+        # Read the installed distributions directly rather than paying for an
+        # interpreter startup and the pip import in a subprocess. The names
+        # come from METADATA, as in pip list, not the normalized directory.
+        # Imported here, importlib.metadata is slow to import and only
+        # needed on a cache miss.
+        import importlib.metadata  # pylint: disable=import-outside-toplevel
+
+        out: list[dict[str, str]] = []
+        with self.lock(exclusive=False):
+            site_packages = _site_packages(self.env_path)
+            paths = [str(site_packages)]
+            # Legacy editable installs point at their project directory.
+            for egg_link in site_packages.glob("*.egg-link"):
+                lines = egg_link.read_text().splitlines()
+                if lines:
+                    paths.append(lines[0].strip())
+            seen: set[str] = set()
+            for dist in importlib.metadata.distributions(path=paths):
+                name = dist.metadata["Name"]
+                if not name or _package_name(name) in seen:
+                    continue
+                seen.add(_package_name(name))
+                out.append({"name": name, "version": dist.version})
+        self._pip_list_cache = (mtime, out, frozenset(seen))
+        return list(out)  # type: ignore
+
+    def pip_install_many(
+        self, packages: list[str], extra_index: str | None = None
+    ) -> None:
+        """Installs all the packages with a single pip invocation.
+
+        Callers should aggregate their packages and call this once rather
+        than once per package, so pip only starts and resolves a single time.
+        """
+        if not packages:
+            return
+        act_env = self._activated_environment()
+        cmd_list = [*_pip_install_cmd(act_env), *packages]
+        if extra_index:
+            cmd_list += ["--extra-index-url", extra_index]
+        _log_command(cmd_list)
+        with self.lock():
+            subprocess.run(cmd_list, env=act_env.env, shell=False, check=True)
+        self._pip_list_cache = None
+
+    def pip_install(self, package: str, extra_index: str | None = None) -> None:
+        """Installs a single package, prefer pip_install_many for several."""
+        self.pip_install_many([package], extra_index)
+
+    def pip_install_parallel(
+        self, items: list[tuple[str, str | None]], workers: int = 4
+    ) -> None:
+        """Installs (package, extra_index) pairs that can't share one pip call.
+
+        The downloads run concurrently, each into its own directory, then a
+        single offline pip install writes to site-packages under the lock.
+        """
+        if not items:
+            return
+        act_env = self._activated_environment()
+        with TemporaryDirectory() as tmp:
+
+            def download(i: int) -> str:
+                package, extra_index = items[i]
+                dest = os.path.join(tmp, str(i))
+                cmd_list = [str(act_env.python), "-m", "pip", "download"]
+                cmd_list += ["--dest", dest, package]
+                if extra_index:
+                    cmd_list += ["--extra-index-url", extra_index]
+                _log_command(cmd_list)
+                subprocess.run(cmd_list, env=act_env.env, shell=False, check=True)
+                return dest
+
+            max_workers = max(1, min(workers, len(items)))
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                dests = list(executor.map(download, range(len(items))))
+            cmd_list = [*_pip_install_cmd(act_env), "--no-index"]
+            for dest in dests:
+                cmd_list += ["--find-links", dest]
+            cmd_list += [package for package, _ in items]
+            _log_command(cmd_list)
+            with self.lock():
+                subprocess.run(cmd_list, env=act_env.env, shell=False, check=True)
+        self._pip_list_cache = None
 
     def pip_has(self, packages: list[str]) -> bool:
         """Returns True if the packages are installed."""
-        pip_list = self.pip_list()
-        pip_list_names = [p["name"] for p in pip_list]  # type: ignore
-        for package in packages:
-            if package not in pip_list_names:
-                return False
-        return True
+        # pip_list keeps the normalized names next to its cached listing.
+        self.pip_list()
+        cache = self._pip_list_cache
+        installed = cache[2] if cache is not None else frozenset()
+        return all(_package_name(package) in installed for package in packages)
 
     # Returns an environment dictionary
     def ensure_installed(
         self, reqs: str | None, args: list[str] | None = None
     ) -> dict[str, Any]:
         """Ensures that the packages are installed."""
+        # Lock-free fast path for the common case of nothing having changed,
+        # the check is repeated under the lock before mutating anything.
+        if self.installed() and self._read_prev_reqs() == reqs:
+            return self.environment()
         with self.lock():
-            prev_reqs: str | None = (
-                self.requirements.read_text() if self.requirements.exists() else None
-            )
-            if prev_reqs == "None":
-                prev_reqs = None
+            prev_reqs = self._read_prev_reqs()
+            if (
+                reqs
+                and prev_reqs
+                and reqs != prev_reqs
+                and self.installed()
+                and _requirement_lines(reqs) == _requirement_lines(prev_reqs)
+            ):
+                # Same requirements, just reordered or reformatted.
+                _write_text_atomic(self.requirements, reqs)
+                return self.environment()
+            if _only_adds_requirements(prev_reqs, reqs) and self.installed():
+                # Keep the installed packages and install on top. pip gets the
+                # full set so an added package can't silently move a pin,
+                # already satisfied requirements cost next to nothing.
+                _pip_install_all(self.env_path, reqs, self.full_isolation, args)  # type: ignore
+                _write_text_atomic(self.requirements, reqs)  # type: ignore
+                self._pip_list_cache = None
+                return self.environment()
             if reqs != prev_reqs:
-                self.clean()
+                # Resetting to the template only removes the user packages,
+                # which is much cheaper than deleting and recreating the venv.
+                if not self.installed() or not _reset_to_template(self.env_path):
+                    self.clean()
+                self._pip_list_cache = None
             if not self.installed():
-                self.install_environment()
+                self._install_environment()
             if prev_reqs == reqs:
                 return self.environment()
             if reqs:
-                # write the requirements
-                self.requirements.write_text(reqs)
-                # install the requirements
+                # install the requirements, then record them
                 _pip_install_all(self.env_path, reqs, self.full_isolation, args)
+                _write_text_atomic(self.requirements, reqs)
+                self._pip_list_cache = None
             return self.environment()
 
     def installed_requirements(self) -> str | None:
         """Returns a list of installed requirements."""
-        return self._read_reqs()
+        with self.lock(exclusive=False):
+            return self._read_reqs()
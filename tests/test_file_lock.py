@@ -0,0 +1,181 @@
+"""
+Unit test file.
+"""
+
+import multiprocessing
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+from isolated_environment.api import FileLock
+
+
+class FileLockTester(unittest.TestCase):
+    """Main tester class."""
+
+    def test_exclusive(self) -> None:
+        """Tests that two holders of the lock never overlap."""
+        with TemporaryDirectory() as tmp_dir:
+            lock_file = str(Path(tmp_dir) / "env.lock")
+            active: list[int] = []
+            overlaps: list[int] = []
+
+            def worker() -> None:
+                # Separate objects, so this also covers separate file handles.
+                with FileLock(lock_file):
+                    active.append(1)
+                    if len(active) > 1:
+                        overlaps.append(1)
+                    time.sleep(0.05)
+                    active.pop()
+
+            threads = [threading.Thread(target=worker) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual([], overlaps)
+
+    @unittest.skipIf(sys.platform == "win32", "Windows has no shared locks")
+    def test_shared(self) -> None:
+        """Tests that shared holders overlap but exclude an exclusive holder."""
+        with TemporaryDirectory() as tmp_dir:
+            lock_file = str(Path(tmp_dir) / "env.lock")
+            reader1, reader2 = FileLock(lock_file), FileLock(lock_file)
+            reader1.acquire(exclusive=False)
+            reader2.acquire(exclusive=False)
+            acquired = threading.Event()
+
+            def writer() -> None:
+                with FileLock(lock_file):
+                    acquired.set()
+
+            thread = threading.Thread(target=writer)
+            thread.start()
+            self.assertFalse(acquired.wait(0.2))
+            reader1.release()
+            reader2.release()
+            thread.join()
+            self.assertTrue(acquired.is_set())
+
+    def test_nested(self) -> None:
+        """Tests that the holder can acquire the lock again."""
+        with TemporaryDirectory() as tmp_dir:
+            lock_file = str(Path(tmp_dir) / "env.lock")
+            lock = FileLock(lock_file)
+            exclusive = sys.platform != "win32"
+
+            def holder() -> None:
+                lock.acquire()
+                lock.acquire()
+                with FileLock(lock_file):
+                    pass
+                lock.acquire(exclusive=False)
+                lock.release()
+                lock.release()
+                lock.release()
+                # A shared hold is upgraded and then restored.
+                lock.acquire(exclusive=False)
+                lock.acquire(exclusive=exclusive)
+                lock.release()
+                lock.release()
+
+            thread = threading.Thread(target=holder, daemon=True)
+            thread.start()
+            thread.join(20)
+            self.assertFalse(thread.is_alive())
+            # Every hold was released, so another thread gets the lock.
+            acquired = threading.Event()
+
+            def other() -> None:
+                with FileLock(lock_file):
+                    acquired.set()
+
+            threading.Thread(target=other, daemon=True).start()
+            self.assertTrue(acquired.wait(20))
+
+    @unittest.skipIf(sys.platform == "win32", "Windows has no shared locks")
+    def test_concurrent_upgrade(self) -> None:
+        """Tests that two shared holders can both upgrade without deadlock."""
+        with TemporaryDirectory() as tmp_dir:
+            lock_file = str(Path(tmp_dir) / "env.lock")
+            barrier = threading.Barrier(2)
+            upgraded: list[int] = []
+
+            def upgrader() -> None:
+                lock = FileLock(lock_file)
+                lock.acquire(exclusive=False)
+                barrier.wait(20)
+                lock.acquire()
+                upgraded.append(1)
+                lock.release()
+                lock.release()
+
+            threads = [threading.Thread(target=upgrader, daemon=True) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(20)
+            self.assertEqual([1, 1], upgraded)
+
+    def test_cross_process(self) -> None:
+        """Tests that the lock excludes another process."""
+        with TemporaryDirectory() as tmp_dir:
+            lock_file = str(Path(tmp_dir) / "env.lock")
+            code = (
+                "import sys, time\n"
+                "from isolated_environment.api import FileLock\n"
+                "with FileLock(sys.argv[1]):\n"
+                "    print('locked', flush=True)\n"
+                "    time.sleep(0.5)\n"
+            )
+            with subprocess.Popen(
+                [sys.executable, "-c", code, lock_file],
+                stdout=subprocess.PIPE,
+                text=True,
+            ) as proc:
+                assert proc.stdout is not None
+                self.assertEqual("locked\n", proc.stdout.readline())
+                start = time.time()
+                with FileLock(lock_file):
+                    self.assertGreater(time.time() - start, 0.2)
+                proc.wait()
+
+    @unittest.skipIf(sys.platform == "win32", "Windows has no fork")
+    def test_fork(self) -> None:
+        """Tests that a forked child doesn't inherit the parent's holders."""
+        with TemporaryDirectory() as tmp_dir:
+            lock_file = str(Path(tmp_dir) / "env.lock")
+            lock = FileLock(lock_file)
+            held, done = threading.Event(), threading.Event()
+
+            def holder() -> None:
+                with lock:
+                    held.set()
+                    done.wait(20)
+
+            def child() -> None:
+                # Blocks on the parent's record lock until it is released.
+                with lock:
+                    pass
+
+            thread = threading.Thread(target=holder, daemon=True)
+            thread.start()
+            self.assertTrue(held.wait(20))
+            proc = multiprocessing.get_context("fork").Process(target=child)
+            proc.start()
+            time.sleep(0.2)
+            done.set()
+            thread.join(20)
+            proc.join(20)
+            if proc.is_alive():
+                proc.kill()
+            self.assertEqual(0, proc.exitcode)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,24 +2,16 @@
 Unit test file.
 """
 
-import json
+import os
 import subprocess
 import sys
 import unittest
 from pathlib import Path
 from tempfile import TemporaryDirectory
-from typing import Any
+from unittest import mock
 
 from isolated_environment.api import IsolatedEnvironment
 
-HERE = Path(__file__).parent
-TEST_DIR = HERE / "test"
-
-
-def pretty(data: Any) -> str:
-    """Make JSON beautiful."""
-    return json.dumps(data, indent=4, sort_keys=True)
-
 
 def get_deps() -> str:
     """Gets the dependencies."""
@@ -42,21 +34,214 @@ class IsolatedEnvironmentTest(unittest.TestCase):
             self.assertTrue(iso_env.installed())
             installed_reqs = iso_env.installed_requirements()
             self.assertEqual(installed_reqs, reqs)
-            try:
-                subprocess.check_output(
-                    ["static_ffmpeg", "--help"],
-                    env=env,
-                    shell=True,  # shell=True is allowed only when NOT running python.
-                )
-            except subprocess.CalledProcessError as exc:
-                # doesn't fail on Windows, but it does on other platforms
-                if sys.platform == "win32":
-                    raise exc
+            # The console script is on the environment's PATH, no need to start it.
+            exe = "static_ffmpeg.exe" if sys.platform == "win32" else "static_ffmpeg"
+            self.assertTrue((Path(env["PATH"].split(os.pathsep)[0]) / exe).exists())
             # Second time should be a no-op.
             iso_env.ensure_installed(reqs)
             iso_env.clean()
             self.assertFalse(iso_env.installed())
 
+    def test_pip_install_many(self) -> None:
+        """Tests that several packages are installed in one go."""
+        with TemporaryDirectory() as tmp_dir:
+            venv_path = Path(tmp_dir) / "venv"
+            iso_env = IsolatedEnvironment(venv_path)
+            iso_env.pip_install_many(["six", "idna"])
+            self.assertTrue(iso_env.pip_has(["six", "idna"]))
+            # A cached pip list must not hide later installs.
+            self.assertFalse(iso_env.pip_has(["certifi"]))
+            iso_env.pip_install_many(["certifi"])
+            self.assertTrue(iso_env.pip_has(["six", "idna", "certifi"]))
+            # Names are compared case-insensitively and without specifiers.
+            self.assertTrue(iso_env.pip_has(["Six>=1.0", "IDNA"]))
+
+    def test_pip_list_names(self) -> None:
+        """Tests that pip_list reports the names from the package metadata."""
+        with TemporaryDirectory() as tmp_dir:
+            venv_path = Path(tmp_dir) / "venv"
+            iso_env = IsolatedEnvironment(venv_path)
+            iso_env.pip_install_many(["MarkupSafe"])
+            # A legacy editable install, linked from site-packages.
+            project = Path(tmp_dir) / "project"
+            (project / "My_Project.egg-info").mkdir(parents=True)
+            (project / "My_Project.egg-info" / "PKG-INFO").write_text(
+                "Metadata-Version: 2.1\nName: My-Project\nVersion: 0.1\n"
+            )
+            site_packages = next(venv_path.glob("**/site-packages"))
+            (site_packages / "My-Project.egg-link").write_text(f"{project}\n.\n")
+            names = {p["name"] for p in iso_env.pip_list()}  # type: ignore
+            self.assertIn("MarkupSafe", names)
+            self.assertIn("My-Project", names)
+            self.assertTrue(iso_env.pip_has(["markupsafe", "my_project"]))
+
+    def test_pip_cache_dir(self) -> None:
+        """Tests that pip's cache is only overridden when asked to."""
+        with TemporaryDirectory() as tmp_dir:
+            venv_path = Path(tmp_dir) / "venv"
+            with mock.patch.dict("os.environ"):
+                os.environ.pop("PIP_CACHE_DIR", None)
+                env = IsolatedEnvironment(venv_path).environment()
+                self.assertNotIn("PIP_CACHE_DIR", env)
+                os.environ["ISOLATED_ENVIRONMENT_PIP_CACHE"] = tmp_dir
+                env = IsolatedEnvironment(venv_path).environment()
+                self.assertEqual(tmp_dir, env["PIP_CACHE_DIR"])
+
+    def test_environment_follows_os_environ(self) -> None:
+        """Tests that one instance sees os.environ changes made after it was created."""
+        with TemporaryDirectory() as tmp_dir:
+            iso_env = IsolatedEnvironment(Path(tmp_dir) / "venv")
+            with mock.patch.dict("os.environ", {"ISO_ENV_TEST_VAR": "late"}):
+                self.assertEqual("late", iso_env.environment()["ISO_ENV_TEST_VAR"])
+                cp = iso_env.run(
+                    [
+                        "python",
+                        "-c",
+                        "import os; print(os.environ['ISO_ENV_TEST_VAR'])",
+                    ],
+                    capture_output=True,
+                    check=True,
+                )
+                self.assertEqual("late", cp.stdout.strip())
+            self.assertNotIn("ISO_ENV_TEST_VAR", iso_env.environment())
+
+    def test_pip_install_parallel(self) -> None:
+        """Tests that packages from separate downloads are installed."""
+        with TemporaryDirectory() as tmp_dir:
+            venv_path = Path(tmp_dir) / "venv"
+            iso_env = IsolatedEnvironment(venv_path)
+            iso_env.pip_install_parallel([("six", None), ("idna", None)])
+            self.assertTrue(iso_env.pip_has(["six", "idna"]))
+
+    def test_batch_run(self) -> None:
+        """Tests that batch_run keeps the order of the commands."""
+        with TemporaryDirectory() as tmp_dir:
+            iso_env = IsolatedEnvironment(Path(tmp_dir) / "venv")
+            cmds = [["python", "-c", f"print({i})"] for i in range(4)]
+            cps = iso_env.batch_run(cmds, capture_output=True, check=True)
+            self.assertEqual(["0", "1", "2", "3"], [cp.stdout.strip() for cp in cps])
+
+    def test_ensure_installed_pinned_no_deps(self) -> None:
+        """Tests that a fully pinned lock is installed with --no-deps."""
+        reqs = "six==1.16.0\nidna==3.7\n"
+        with TemporaryDirectory() as tmp_dir:
+            venv_path = Path(tmp_dir) / "venv"
+            iso_env = IsolatedEnvironment(venv_path)
+            iso_env.ensure_installed(reqs, args=["--no-deps"])
+            self.assertEqual(reqs, iso_env.installed_requirements())
+            scripts = "Scripts" if sys.platform == "win32" else "bin"
+            python = venv_path / scripts / "python"
+            subprocess.check_call([str(python), "-c", "import six, idna"])
+
+    def test_ensure_installed_pinned_markers(self) -> None:
+        """Tests that environment markers survive the parallel pinned install."""
+        reqs = (
+            'six==1.16.0 ; python_version >= "3.0"\n'
+            'idna==3.7 ; python_version < "3.0"\n'
+        )
+        with TemporaryDirectory() as tmp_dir:
+            iso_env = IsolatedEnvironment(Path(tmp_dir) / "venv")
+            iso_env.ensure_installed(reqs, args=["--no-deps"])
+            self.assertTrue(iso_env.pip_has(["six"]))
+            self.assertFalse(iso_env.pip_has(["idna"]))
+
+    def test_ensure_installed_pinned_hashes(self) -> None:
+        """Tests a pip-compile style lock with hashes and line continuations."""
+        idna_hashes = [
+            "028ff3aadf0609c1fd278d8ea3089299412a7a8b9bd005dd08b9f8285bcb5cfc",
+            "82fee1fc78add43492d3a1898bfa6d8a904cc97d8427f683ed8e798d07761aa0",
+        ]
+        six_hashes = [
+            "1e61c37477a1626458e36f7b1d82aa5c9b094fa4802892072e49de9c60c4c926",
+            "8abb2f1d86890a2dfb989f9a77cfcfd3e47c2a354b01111771326f8aa26e0254",
+        ]
+        reqs = (
+            "idna==3.7 \\\n"
+            f"    --hash=sha256:{idna_hashes[0]} \\\n"
+            f"    --hash=sha256:{idna_hashes[1]}\n"
+            "    # via -r requirements.in\n"
+            "six==1.16.0 \\\n"
+            f"    --hash=sha256:{six_hashes[0]} \\\n"
+            f"    --hash=sha256:{six_hashes[1]}\n"
+        )
+        with TemporaryDirectory() as tmp_dir:
+            iso_env = IsolatedEnvironment(Path(tmp_dir) / "venv")
+            iso_env.ensure_installed(reqs, args=["--no-deps"])
+            self.assertTrue(iso_env.pip_has(["six", "idna"]))
+
+    def test_ensure_installed_incremental(self) -> None:
+        """Tests that adding a requirement does not rebuild the environment."""
+        with TemporaryDirectory() as tmp_dir:
+            venv_path = Path(tmp_dir) / "venv"
+            iso_env = IsolatedEnvironment(venv_path, requirements="six\n")
+            marker = venv_path / "marker.txt"
+            marker.write_text("still here")
+            iso_env.ensure_installed("six\nidna\n")
+            self.assertTrue(marker.exists())
+            self.assertEqual("six\nidna\n", iso_env.installed_requirements())
+            self.assertTrue(iso_env.pip_has(["six", "idna"]))
+            # Reordering the requirements is not a change.
+            iso_env.ensure_installed("idna\nsix\n")
+            self.assertTrue(marker.exists())
+            # Removing a requirement drops the previously installed packages.
+            iso_env.ensure_installed("idna\n")
+            self.assertFalse(marker.exists())
+            self.assertFalse(iso_env.pip_has(["six"]))
+            self.assertTrue(iso_env.pip_has(["idna", "pip"]))
+
+    def test_ensure_installed_incremental_conflict(self) -> None:
+        """Tests that an added requirement can't move an earlier pin."""
+        with TemporaryDirectory() as tmp_dir:
+            venv_path = Path(tmp_dir) / "venv"
+            iso_env = IsolatedEnvironment(venv_path, requirements="six==1.16.0\n")
+            with self.assertRaises(subprocess.CalledProcessError):
+                iso_env.ensure_installed("six==1.16.0\nsix==1.15.0\n")
+            # The record still describes what is installed.
+            self.assertEqual("six==1.16.0\n", iso_env.installed_requirements())
+            self.assertEqual(
+                ["requirements.txt"], [p.name for p in venv_path.glob("req*.txt")]
+            )
+
+    @unittest.skipIf(sys.platform == "win32", "Windows does not use the template")
+    def test_template_is_relocated(self) -> None:
+        """Tests that an environment copied from the template uses its own paths."""
+        with TemporaryDirectory() as tmp_dir:
+            venv_path = Path(tmp_dir) / "venv"
+            IsolatedEnvironment(venv_path)
+            shebang = (venv_path / "bin" / "pip").read_text().splitlines()[0]
+            self.assertEqual(f"#!{venv_path / 'bin' / 'python'}", shebang)
+
+    @unittest.skipIf(sys.platform == "win32", "Windows does not use the template")
+    def test_template_hardlink_mode(self) -> None:
+        """Tests that relocating a hard linked copy leaves the template alone."""
+        with TemporaryDirectory() as tmp_dir:
+            venv_path = Path(tmp_dir) / "venv"
+            with mock.patch.dict(
+                "os.environ", {"ISOLATED_ENVIRONMENT_LINK_MODE": "hardlink"}
+            ):
+                IsolatedEnvironment(venv_path)
+            template = Path(
+                (venv_path / ".isolated_environment_from_template").read_text()
+            )
+            shebang = (template / "bin" / "pip").read_text().splitlines()[0]
+            self.assertEqual(f"#!{template / 'bin' / 'python'}", shebang)
+            shebang = (venv_path / "bin" / "pip").read_text().splitlines()[0]
+            self.assertEqual(f"#!{venv_path / 'bin' / 'python'}", shebang)
+            self.assertTrue(os.access(venv_path / "bin" / "pip", os.X_OK))
+
+    @unittest.skipIf(sys.platform == "win32", "Windows does not use the template")
+    def test_template_in_xdg_cache_home(self) -> None:
+        """Tests that the template is kept under XDG_CACHE_HOME."""
+        with TemporaryDirectory() as tmp_dir:
+            cache_home = Path(tmp_dir) / "cache"
+            venv_path = Path(tmp_dir) / "venv"
+            with mock.patch.dict("os.environ", {"XDG_CACHE_HOME": str(cache_home)}):
+                IsolatedEnvironment(venv_path)
+            template = Path(
+                (venv_path / ".isolated_environment_from_template").read_text()
+            )
+            self.assertEqual(cache_home / "isolated_environment", template.parent)
+
 
 if __name__ == "__main__":
     unittest.main()
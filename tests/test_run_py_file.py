@@ -2,12 +2,20 @@
 Unit test file.
 """
 
+import shlex
 import subprocess
+import sys
 import unittest
 from pathlib import Path
 from tempfile import TemporaryDirectory
+from typing import Any
+from unittest import mock
 
-from isolated_environment import isolated_environment, isolated_environment_run
+from isolated_environment import (
+    isolated_environment,
+    isolated_environment_run,
+    isolated_environments_bulk,
+)
 
 HERE = Path(__file__).parent
 
@@ -17,46 +25,83 @@ RUN_PY = HERE / "run.py"
 class MainTester(unittest.TestCase):
     """Main tester class."""
 
+    tmp_dir: TemporaryDirectory
+    venv_path: Path
+    env: dict[str, Any]
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        # The tests only run python in the environment, so they can share it.
+        cls.tmp_dir = TemporaryDirectory()  # pylint: disable=consider-using-with
+        cls.venv_path = Path(cls.tmp_dir.name) / "venv"
+        cls.env = isolated_environment(cls.venv_path, [])
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.tmp_dir.cleanup()
+
     def test_shell(self) -> None:
         """Test command line interface (CLI)."""
-        with TemporaryDirectory() as tmp_dir:
-            venv_path = Path(tmp_dir) / "venv"
-            env = isolated_environment(venv_path, [])
-            cmd_list = [
-                "python",
-                str(RUN_PY),
-            ]
-            stdout: str = subprocess.check_output(
-                cmd_list, env=env, shell=True, universal_newlines=True
-            )
-            self.assertEqual("Hello World!\n", stdout)
+        cmd_list = [
+            "python",
+            str(RUN_PY),
+        ]
+        # With shell=True the command must be a single string, a list only
+        # passes its first item to the shell on POSIX.
+        if sys.platform == "win32":
+            cmd = subprocess.list2cmdline(cmd_list)
+        else:
+            cmd = shlex.join(cmd_list)
+        stdout: str = subprocess.check_output(
+            cmd, env=self.env, shell=True, universal_newlines=True
+        )
+        self.assertEqual("Hello World!\n", stdout)
 
     def test_no_shell(self) -> None:
         """Test command line interface (CLI)."""
-        with TemporaryDirectory() as tmp_dir:
-            venv_path = Path(tmp_dir) / "venv"
-            env = isolated_environment(venv_path, [])
-            cmd_list = [
-                "python",
-                str(RUN_PY),
-            ]
-            stdout: str = subprocess.check_output(
-                cmd_list, env=env, shell=False, universal_newlines=True
-            )
-            self.assertEqual("Hello World!\n", stdout)
+        cmd_list = [
+            "python",
+            str(RUN_PY),
+        ]
+        stdout: str = subprocess.check_output(
+            cmd_list, env=self.env, shell=False, universal_newlines=True
+        )
+        self.assertEqual("Hello World!\n", stdout)
 
     def test_isolated_environment_run(self) -> None:
         """Test command line interface (CLI)."""
-        with TemporaryDirectory() as tmp_dir:
-            venv_path = Path(tmp_dir) / "venv"
+        cp = isolated_environment_run(
+            env_path=self.venv_path,
+            requirements=[],
+            cmd_list=["python", str(RUN_PY)],
+            capture_output=True,
+        )
+        self.assertEqual(0, cp.returncode)
+        self.assertEqual("Hello World!\n", cp.stdout)
+
+    def test_environment_set_after_import(self) -> None:
+        """Tests that variables set after the import reach the command."""
+        with mock.patch.dict("os.environ", {"MY_SETTING": "hello"}):
             cp = isolated_environment_run(
-                env_path=venv_path,
+                env_path=self.venv_path,
                 requirements=[],
-                cmd_list=["python", str(RUN_PY)],
+                cmd_list=[
+                    "python",
+                    "-c",
+                    "import os; print(os.environ.get('MY_SETTING'))",
+                ],
                 capture_output=True,
             )
-            self.assertEqual(0, cp.returncode)
-            self.assertEqual("Hello World!\n", cp.stdout)
+        self.assertEqual("hello\n", cp.stdout)
+
+    def test_isolated_environments_bulk(self) -> None:
+        """Test creating several environments at once."""
+        with TemporaryDirectory() as tmp_dir:
+            venv_paths = [Path(tmp_dir) / "venv1", Path(tmp_dir) / "venv2"]
+            envs = isolated_environments_bulk([(p, []) for p in venv_paths])
+            self.assertEqual(2, len(envs))
+            for venv_path, env in zip(venv_paths, envs):
+                self.assertEqual(str(venv_path), env["VIRTUAL_ENV"])
 
 
 if __name__ == "__main__":